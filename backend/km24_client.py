@@ -4,26 +4,39 @@ KM24 API Client
 Wrapper for KM24 API til at hente moduler, oprette steps og hente hits.
 """
 
+import asyncio
 import httpx
 import logging
-from typing import Dict, List, Any, Optional
-from pydantic import BaseModel
+import math
+import msgspec
+import orjson
+import time
+from typing import Dict, List, Any, Optional, Tuple
 
 logger = logging.getLogger("km24_client")
 
 KM24_BASE_URL = "https://km24.dk/api"
 
+# Largest pageSize the KM24 API accepts
+KM24_MAX_PAGE_SIZE = 200
 
-class KM24Module(BaseModel):
+# Max temporary-step validations (create step + fetch hits) a client runs at once
+MAX_CONCURRENT_VALIDATIONS = 8
+
+# Module part definitions change rarely, so module details are cached for an hour
+MODULE_CACHE_TTL = 3600.0
+
+
+class KM24Module(msgspec.Struct):
     """KM24 Module information."""
     id: int
     title: str
-    emoji: str
+    emoji: str = "📊"
     description: Optional[str] = None
     parts: List[Dict[str, Any]] = []
 
 
-class KM24Part(BaseModel):
+class KM24Part(msgspec.Struct):
     """KM24 Module Part (filter)."""
     id: int
     name: str
@@ -31,20 +44,54 @@ class KM24Part(BaseModel):
     type: str
 
 
+class KM24ModuleList(msgspec.Struct):
+    """Response from /modules/basic."""
+    items: List[KM24Module] = []
+
+
+# Typed decoders reused across calls; decode straight from response bytes
+_MODULE_LIST_DECODER = msgspec.json.Decoder(KM24ModuleList)
+_MODULE_DECODER = msgspec.json.Decoder(KM24Module)
+
+
 class KM24Client:
     """Client for interacting with KM24 API."""
 
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.headers = {"X-API-Key": api_key}
+        # One shared client for the app lifetime so connections are reused
         self.client = httpx.AsyncClient(
+            base_url=KM24_BASE_URL,
+            http2=True,
             timeout=30.0,
-            headers=self.headers
+            headers=self.headers,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
         )
         self._modules_cache: Optional[List[KM24Module]] = None
+        self._modules_count: Optional[int] = None
+        # Serialized /api/modules response body, rebuilt whenever the modules cache is refreshed
+        self._modules_json: Optional[bytes] = None
+        # Top-20 module list for the recipe prompt, rebuilt with the modules cache
+        self._modules_prompt_block: Optional[str] = None
+        # In-flight /modules/basic fetch shared by concurrent get_modules() calls
+        self._modules_fetch: Optional[asyncio.Future] = None
+        # Acquired by callers around batched validations; single KM24 calls aren't gated
+        self.validation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_VALIDATIONS)
+        # module_id -> (module, part slug -> part id, fetched at)
+        self._module_cache: Dict[int, Tuple[KM24Module, Dict[str, int], float]] = {}
+
+    @property
+    def modules_count(self) -> Optional[int]:
+        """Number of cached modules, or None if the cache hasn't been populated yet."""
+        return self._modules_count
 
     async def close(self):
         """Close the HTTP client."""
+        # A shielded module fetch survives its callers being cancelled; stop it first
+        if self._modules_fetch and not self._modules_fetch.done():
+            self._modules_fetch.cancel()
+            await asyncio.gather(self._modules_fetch, return_exceptions=True)
         await self.client.aclose()
 
     async def get_modules(self, force_refresh: bool = False) -> List[KM24Module]:
@@ -60,58 +107,96 @@ class KM24Client:
         if self._modules_cache and not force_refresh:
             return self._modules_cache
 
-        try:
-            response = await self.client.get(f"{KM24_BASE_URL}/modules/basic")
-            response.raise_for_status()
-            data = response.json()
-
-            modules = [
-                KM24Module(
-                    id=m["id"],
-                    title=m["title"],
-                    emoji=m.get("emoji", "📊"),
-                    description=m.get("description")
-                )
-                for m in data.get("items", [])
+        # Share an in-flight fetch (e.g. the startup warmup) instead of sending a duplicate
+        if self._modules_fetch is None or self._modules_fetch.done():
+            self._modules_fetch = asyncio.ensure_future(self._fetch_modules())
+        return await asyncio.shield(self._modules_fetch)
+
+    async def _fetch_modules(self) -> List[KM24Module]:
+        """Fetch the module list and rebuild everything derived from it."""
+        response = await self.client.get("/modules/basic")
+        response.raise_for_status()
+        modules = _MODULE_LIST_DECODER.decode(response.content).items
+
+        self._modules_cache = modules
+        self._modules_count = len(modules)
+        self._modules_json = orjson.dumps({
+            "modules": [
+                {
+                    "id": m.id,
+                    "title": m.title,
+                    "emoji": m.emoji,
+                    "description": m.description
+                }
+                for m in modules
             ]
+        })
+        self._modules_prompt_block = "\n".join([
+            f"{m.id}. {m.title} {m.emoji}"
+            for m in modules[:20]  # Include top 20 modules
+        ])
+        logger.info(f"Loaded {len(modules)} modules from KM24")
+        return modules
+
+    async def get_modules_json(self) -> bytes:
+        """
+        Get the module list serialized as JSON.
+
+        Returns:
+            JSON body of the form {"modules": [{"id", "title", "emoji", "description"}, ...]}
+        """
+        if self._modules_json is None:
+            await self.get_modules()
+        return self._modules_json
 
-            self._modules_cache = modules
-            logger.info(f"Loaded {len(modules)} modules from KM24")
-            return modules
+    async def get_modules_prompt_block(self) -> str:
+        """
+        Get the top 20 modules formatted for the recipe prompt.
 
-        except Exception as e:
-            logger.error(f"Error fetching modules: {e}")
-            raise
+        Returns:
+            One "<id>. <title> <emoji>" line per module
+        """
+        if self._modules_prompt_block is None:
+            await self.get_modules()
+        return self._modules_prompt_block
 
-    async def get_module(self, module_id: int) -> KM24Module:
+    async def get_module(self, module_id: int, force_refresh: bool = False) -> KM24Module:
         """
         Get detailed information about a specific module including its parts (filters).
 
         Args:
             module_id: The module ID
+            force_refresh: Force refresh from API instead of using cache
 
         Returns:
             Module with parts
         """
-        try:
-            response = await self.client.get(f"{KM24_BASE_URL}/modules/basic/{module_id}")
-            response.raise_for_status()
-            data = response.json()
+        cached = self._module_cache.get(module_id)
+        if cached and not force_refresh and time.monotonic() - cached[2] < MODULE_CACHE_TTL:
+            return cached[0]
+
+        response = await self.client.get(f"/modules/basic/{module_id}")
+        response.raise_for_status()
+        module = _MODULE_DECODER.decode(response.content)
+
+        part_map = {p["slug"]: p["id"] for p in module.parts}
+        self._module_cache[module_id] = (module, part_map, time.monotonic())
 
-            module = KM24Module(
-                id=data["id"],
-                title=data["title"],
-                emoji=data.get("emoji", "📊"),
-                description=data.get("description"),
-                parts=data.get("parts", [])
-            )
+        logger.info(f"Loaded module {module_id}: {module.title} with {len(module.parts)} parts")
+        return module
 
-            logger.info(f"Loaded module {module_id}: {module.title} with {len(module.parts)} parts")
-            return module
+    async def get_module_with_parts(self, module_id: int) -> Tuple[KM24Module, Dict[str, int]]:
+        """
+        Get a module together with its part map.
+
+        Args:
+            module_id: The module ID
 
-        except Exception as e:
-            logger.error(f"Error fetching module {module_id}: {e}")
-            raise
+        Returns:
+            Tuple of module and a mapping from part slug to part ID
+        """
+        module = await self.get_module(module_id)
+        return module, self._module_cache[module_id][1]
 
     async def create_step(
         self,
@@ -132,27 +217,22 @@ class KM24Client:
         Returns:
             Created step with ID
         """
-        try:
-            step_data = {
-                "name": name,
-                "moduleId": module_id,
-                "lookbackDays": lookback_days,
-                "parts": parts
-            }
-
-            response = await self.client.post(
-                f"{KM24_BASE_URL}/steps/main/",
-                json=step_data
-            )
-            response.raise_for_status()
-            step = response.json()
-
-            logger.info(f"Created step {step['id']}: {name}")
-            return step
+        step_data = {
+            "name": name,
+            "moduleId": module_id,
+            "lookbackDays": lookback_days,
+            "parts": parts
+        }
+
+        response = await self.client.post(
+            "/steps/main/",
+            json=step_data
+        )
+        response.raise_for_status()
+        step = orjson.loads(response.content)
 
-        except Exception as e:
-            logger.error(f"Error creating step: {e}")
-            raise
+        logger.info(f"Created step {step['id']}: {name}")
+        return step
 
     async def get_step_hits(
         self,
@@ -173,24 +253,54 @@ class KM24Client:
         Returns:
             Hits data with count and items
         """
-        try:
-            response = await self.client.get(
-                f"{KM24_BASE_URL}/steps/main/hits/{step_id}",
-                params={
-                    "page": page,
-                    "pageSize": page_size,
-                    "ordering": ordering
-                }
-            )
-            response.raise_for_status()
-            hits = response.json()
+        response = await self.client.get(
+            f"/steps/main/hits/{step_id}",
+            params={
+                "page": page,
+                "pageSize": page_size,
+                "ordering": ordering
+            }
+        )
+        response.raise_for_status()
+        hits = orjson.loads(response.content)
 
-            logger.info(f"Fetched {len(hits.get('items', []))} hits from step {step_id}")
-            return hits
+        logger.info(f"Fetched {len(hits.get('items', []))} hits from step {step_id}")
+        return hits
 
-        except Exception as e:
-            logger.error(f"Error fetching hits from step {step_id}: {e}")
-            raise
+    async def get_step_hits_many(
+        self,
+        step_id: int,
+        total: int,
+        page_size: int = KM24_MAX_PAGE_SIZE,
+        ordering: str = "-hitDatetime"
+    ) -> Dict[str, Any]:
+        """
+        Get up to `total` hits from a step, fetching the remaining pages concurrently.
+
+        Args:
+            step_id: Step ID
+            total: Maximum number of hits to fetch
+            page_size: Number of hits per page
+            ordering: Sort order (default: newest first)
+
+        Returns:
+            Hits data with count and the combined items of all fetched pages
+        """
+        first_page = await self.get_step_hits(step_id, page=1, page_size=page_size, ordering=ordering)
+        items = list(first_page.get("items", []))
+        # Without a count, only the page already fetched is known to exist
+        total = min(total, first_page.get("count", len(items)))
+        num_pages = math.ceil(total / page_size)
+
+        if num_pages > 1:
+            pages = await asyncio.gather(*(
+                self.get_step_hits(step_id, page=p, page_size=page_size, ordering=ordering)
+                for p in range(2, num_pages + 1)
+            ))
+            for page in pages:
+                items.extend(page.get("items", []))
+
+        return {**first_page, "items": items[:total]}
 
     async def delete_step(self, step_id: int) -> None:
         """
@@ -199,14 +309,9 @@ class KM24Client:
         Args:
             step_id: Step ID to delete
         """
-        try:
-            response = await self.client.delete(f"{KM24_BASE_URL}/steps/main/{step_id}/")
-            response.raise_for_status()
-            logger.info(f"Deleted step {step_id}")
-
-        except Exception as e:
-            logger.error(f"Error deleting step {step_id}: {e}")
-            raise
+        response = await self.client.delete(f"/steps/main/{step_id}/")
+        response.raise_for_status()
+        logger.info(f"Deleted step {step_id}")
 
     async def search_company(self, query: str) -> List[Dict[str, Any]]:
         """
@@ -218,17 +323,12 @@ class KM24Client:
         Returns:
             List of company search results with CVR numbers
         """
-        try:
-            response = await self.client.get(
-                f"{KM24_BASE_URL}/companies/add/search",
-                params={"q": query}
-            )
-            response.raise_for_status()
-            data = response.json()
-
-            logger.info(f"Found {len(data.get('results', []))} companies for query: {query}")
-            return data.get("results", [])
+        response = await self.client.get(
+            "/companies/add/search",
+            params={"q": query}
+        )
+        response.raise_for_status()
+        data = orjson.loads(response.content)
 
-        except Exception as e:
-            logger.error(f"Error searching companies: {e}")
-            raise
+        logger.info(f"Found {len(data.get('results', []))} companies for query: {query}")
+        return data.get("results", [])
@@ -5,19 +5,25 @@ FastAPI backend der integrerer med Anthropic Claude og KM24 API
 til at generere monitoring strategier.
 """
 
+import asyncio
 import os
-from typing import Any, Dict, List, Optional
-from fastapi import FastAPI, HTTPException
+from typing import Any, Dict, List, Optional, Tuple
+import httpx
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import logging
 from contextlib import asynccontextmanager
-import json
 import re
+import time
+from collections import OrderedDict
+
+import orjson
 
 from anthropic import Anthropic
-from km24_client import KM24Client
+from km24_client import KM24Client, KM24Module, KM24_MAX_PAGE_SIZE, MODULE_CACHE_TTL
 
 # Load environment variables
 load_dotenv()
@@ -46,20 +52,75 @@ else:
     km24_client = KM24Client(api_key=KM24_API_KEY)
 
 
+# --- Module cache warmup ---
+WARMUP_RETRY_INITIAL_DELAY = 1.0
+WARMUP_RETRY_MAX_DELAY = 60.0
+
+
+async def _prefetch_module_details(modules: List[KM24Module], force_refresh: bool = False) -> None:
+    """Fetch details for all modules concurrently so their part maps are cached."""
+    results = await asyncio.gather(
+        *(km24_client.get_module(m.id, force_refresh=force_refresh) for m in modules),
+        return_exceptions=True
+    )
+    failed = sum(1 for r in results if isinstance(r, Exception))
+    logger.info(f"Prefetched details for {len(modules) - failed}/{len(modules)} KM24 modules")
+
+
+async def _warm_module_cache() -> None:
+    """Load the module list, retrying with backoff, then prefetch module details."""
+    delay = WARMUP_RETRY_INITIAL_DELAY
+    while True:
+        try:
+            modules = await km24_client.get_modules()
+            break
+        except Exception as e:
+            # Lets /health tell a KM24 outage apart from a cold start
+            # repr, since httpx timeouts often have an empty message
+            app.state.warmup_error = repr(e)
+            logger.error(f"Failed to cache modules, retrying in {delay:.0f}s: {e!r}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_RETRY_MAX_DELAY)
+
+    app.state.warmup_error = None
+    logger.info("KM24 modules cached successfully")
+    await _prefetch_module_details(modules)
+
+
+async def _refresh_module_cache_periodically() -> None:
+    """Refresh the module list and module details once per cache TTL."""
+    while True:
+        await asyncio.sleep(MODULE_CACHE_TTL)
+        try:
+            modules = await km24_client.get_modules(force_refresh=True)
+            await _prefetch_module_details(modules, force_refresh=True)
+        except Exception as e:
+            logger.error(f"Failed to refresh module cache: {e}")
+
+
 # --- Lifespan context manager ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Setup and teardown for the application."""
     logger.info("Starting KM24 Agent backend...")
-    # Load modules cache on startup
+    refresh_task = None
+    app.state.warmup_task = None
+    # Load modules cache in the background so startup doesn't wait on KM24;
+    # /health reports "warming" until it is populated
     if km24_client:
-        try:
-            await km24_client.get_modules()
-            logger.info("KM24 modules cached successfully")
-        except Exception as e:
-            logger.error(f"Failed to cache modules: {e}")
+        app.state.warmup_task = asyncio.create_task(_warm_module_cache())
+        refresh_task = asyncio.create_task(_refresh_module_cache_periodically())
     yield
     # Shutdown: cleanup
+    startup_tasks = [t for t in (app.state.warmup_task, refresh_task) if t]
+    for task in startup_tasks:
+        task.cancel()
+    # Wait for the cancellations so no KM24 call is still running when the client closes
+    await asyncio.gather(*startup_tasks, return_exceptions=True)
+    # Let pending fetches and step cleanup finish before the HTTP client is closed.
+    # Loop because a finishing fetch schedules its step deletion as a new task.
+    while app.state.background_tasks:
+        await asyncio.gather(*list(app.state.background_tasks), return_exceptions=True)
     if km24_client:
         await km24_client.close()
     logger.info("Shutting down KM24 Agent backend...")
@@ -71,8 +132,15 @@ app = FastAPI(
     description="Backend for KM24 monitoring wizard",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+# Background tasks (shared KM24 fetches, temporary step cleanup) that outlive their request;
+# set up here rather than in lifespan so it exists even if lifespan never runs
+app.state.background_tasks = set()
+# Last module cache warmup error, cleared once the cache is populated
+app.state.warmup_error = None
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -83,6 +151,20 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(httpx.HTTPError)
+async def km24_http_error_handler(request: Request, exc: httpx.HTTPError):
+    """Map errors from the KM24 API to 502 Bad Gateway."""
+    logger.error(f"KM24 API error on {request.url.path}: {exc}")
+    return ORJSONResponse(status_code=502, content={"detail": f"KM24 API error: {exc}"})
+
+
+# Hits fetched when validating filters
+HITS_PAGE_SIZE = 10
+# Searches beyond KM24_MAX_PAGE_SIZE hits fetch several full pages concurrently.
+# KM24 enforces no total; this cap is ours and bounds one search to 5 page requests.
+MAX_SEARCH_HITS = 1000
+
+
 # --- Request/Response Models ---
 class GenerateRecipeRequest(BaseModel):
     goal: str = Field(..., description="Journalistisk mål for overvågning")
@@ -137,30 +219,81 @@ class ValidationResult(BaseModel):
 class SearchHitsRequest(BaseModel):
     module_id: int = Field(..., description="KM24 module ID")
     filters: Dict[str, Any] = Field(..., description="Filter configuration")
-    limit: int = Field(default=10, description="Maximum hits to return")
+    limit: int = Field(default=10, ge=1, le=MAX_SEARCH_HITS, description="Maximum hits to return")
+
+
+class ModuleValidation(BaseModel):
+    """Validation result for one module of a recipe strategy."""
+    strategy_name: str = Field(..., description="Strategy the module belongs to")
+    module_id: int = Field(..., description="KM24 module ID")
+    result: Optional[ValidationResult] = Field(None, description="Validation result for the module filters")
+    error: Optional[str] = Field(None, description="Why the module couldn't be validated")
 
 
 # --- Helper Functions ---
-async def generate_recipe_with_ai(goal: str) -> MonitoringRecipe:
-    """
-    Generate monitoring recipe using Anthropic Claude.
+class _TTLCache:
+    """Small LRU cache whose entries expire after a fixed TTL."""
+
+    def __init__(self, ttl: float, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Any) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, key: Any, value: Any) -> None:
+        """Remove key, but only if it still maps to value."""
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is value:
+            del self._data[key]
+
+
+# Short-lived caches so re-submitting identical filters skips the KM24 round-trips
+VALIDATION_CACHE_TTL = 60.0
+# Entries hold tasks, so identical concurrent requests share one in-flight KM24 call
+_validation_cache = _TTLCache(ttl=VALIDATION_CACHE_TTL)  # key -> Task[ValidationResult]
+_hits_cache = _TTLCache(ttl=VALIDATION_CACHE_TTL)  # key -> (hits fetched, Task[hits data])
+
+
+def _evict_if_failed(cache: _TTLCache, key: Any, entry: Any, task: asyncio.Task) -> None:
+    """Drop a cached task that failed so the next request retries instead of reusing the error."""
+    if task.cancelled() or task.exception():
+        cache.discard(key, entry)
+
+
+def _filters_cache_key(module_id: int, filters: Dict[str, Any]) -> Optional[Tuple[int, bytes]]:
     """
-    if not anthropic_client:
-        raise HTTPException(status_code=500, detail="Anthropic API not configured")
+    Build a hashable cache key from a module ID and its (possibly nested) filters.
 
-    if not km24_client:
-        raise HTTPException(status_code=500, detail="KM24 API not configured")
+    Returns None if the filters can't be serialized (e.g. integers beyond 64 bits),
+    in which case callers skip the cache.
+    """
+    try:
+        return module_id, orjson.dumps(filters, option=orjson.OPT_SORT_KEYS)
+    except orjson.JSONEncodeError:
+        return None
 
-    # Get available modules
-    modules = await km24_client.get_modules()
 
-    # Create module reference for prompt
-    module_list = "\n".join([
-        f"{m.id}. {m.title} {m.emoji}"
-        for m in modules[:20]  # Include top 20 modules
-    ])
+# A ```json fenced block is preferred anywhere in the response; raw JSON is the fallback
+_JSON_BLOCK_RE = re.compile(r'```json\s*\n(.*?)\n```', re.DOTALL)
+_JSON_ANY_RE = re.compile(r'\{.*\}', re.DOTALL)
 
-    prompt = f"""Du er en ekspert i at hjælpe danske journalister med at opsætte overvågningsstrategier i KM24-platformen.
+# Static prompt skeleton; only goal and module_list are filled in per request
+_RECIPE_PROMPT_TEMPLATE = """Du er en ekspert i at hjælpe danske journalister med at opsætte overvågningsstrategier i KM24-platformen.
 
 Journalistens mål: {goal}
 
@@ -215,6 +348,22 @@ Returnér JSON i dette format:
 }}
 """
 
+
+async def generate_recipe_with_ai(goal: str) -> MonitoringRecipe:
+    """
+    Generate monitoring recipe using Anthropic Claude.
+    """
+    if not anthropic_client:
+        raise HTTPException(status_code=500, detail="Anthropic API not configured")
+
+    if not km24_client:
+        raise HTTPException(status_code=500, detail="KM24 API not configured")
+
+    # Module reference for prompt (cached on the client)
+    module_list = await km24_client.get_modules_prompt_block()
+
+    prompt = _RECIPE_PROMPT_TEMPLATE.format(goal=goal, module_list=module_list)
+
     try:
         message = anthropic_client.messages.create(
             model="claude-3-5-sonnet-20241022",
@@ -226,51 +375,136 @@ Returnér JSON i dette format:
         response_text = message.content[0].text
 
         # Try to extract JSON from markdown code block
-        json_match = re.search(r'```json\n(.*?)\n```', response_text, re.DOTALL)
+        json_match = _JSON_BLOCK_RE.search(response_text)
         if json_match:
             json_str = json_match.group(1)
         else:
             # Try to find raw JSON
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
+            json_match = _JSON_ANY_RE.search(response_text)
             if json_match:
                 json_str = json_match.group(0)
             else:
                 raise ValueError("Could not find JSON in response")
 
-        recipe_data = json.loads(json_str)
-        return MonitoringRecipe(**recipe_data)
+        return MonitoringRecipe.model_validate_json(json_str)
 
     except Exception as e:
         logger.error(f"Error generating recipe with AI: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate recipe: {str(e)}")
 
 
-async def validate_filters_with_km24(module_id: int, filters: Dict[str, Any]) -> ValidationResult:
+def _to_hit(hit: Dict[str, Any]) -> Hit:
+    """Convert a raw KM24 hit to our Hit format."""
+    # Skips validation for speed, so values come straight from KM24 JSON unchecked.
+    # title is the only required field; fall back if KM24 sends null for it.
+    return Hit.model_construct(
+        title=hit.get("title") or "Untitled",
+        date=hit.get("hitDatetime"),
+        summary=hit.get("summary", hit.get("description", "")),
+        url=hit.get("url")
+    )
+
+
+def _track_background_task(task: asyncio.Task) -> asyncio.Task:
+    """Keep a reference to a task so it isn't garbage collected and is drained on shutdown."""
+    app.state.background_tasks.add(task)
+    task.add_done_callback(app.state.background_tasks.discard)
+    return task
+
+
+def _schedule_step_deletion(step_id: int) -> None:
+    """Delete a temporary step in the background instead of blocking the response."""
+    task = _track_background_task(asyncio.create_task(km24_client.delete_step(step_id)))
+
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logger.error(f"Failed to delete temporary step {step_id}: {task.exception()}")
+
+    task.add_done_callback(_log_failure)
+
+
+async def _fetch_hits(module_id: int, filters: Dict[str, Any], limit: int) -> Optional[Dict[str, Any]]:
     """
-    Validate filters by creating a temporary step and checking hits.
+    Create a temporary step for the filters, fetch up to limit hits and
+    schedule the step for deletion.
+
+    Returns:
+        Hits data, or None if none of the filters map to parts of the module
     """
-    if not km24_client:
-        raise HTTPException(status_code=500, detail="KM24 API not configured")
+    # Get module part map (cached on the client)
+    module, part_map = await km24_client.get_module_with_parts(module_id)
+
+    # Convert filters to parts
+    parts = []
+    for filter_name, filter_value in filters.items():
+        if filter_value and filter_name in part_map:
+            # Ensure value is a list
+            values = [filter_value] if not isinstance(filter_value, list) else filter_value
+            parts.append({
+                "modulePartId": part_map[filter_name],
+                "values": values
+            })
+
+    if not parts:
+        return None
+
+    # Create temporary step
+    step_name = f"__temp_validation_{module_id}"
+    step = await km24_client.create_step(
+        name=step_name,
+        module_id=module_id,
+        parts=parts,
+        lookback_days=30
+    )
+
+    step_id = step["id"]
+
+    # Get hits, then delete the temporary step in the background
+    try:
+        if limit > KM24_MAX_PAGE_SIZE:
+            return await km24_client.get_step_hits_many(step_id, total=limit, page_size=KM24_MAX_PAGE_SIZE)
+        return await km24_client.get_step_hits(step_id, page_size=limit)
+    finally:
+        _schedule_step_deletion(step_id)
+
+
+async def _create_and_fetch(module_id: int, filters: Dict[str, Any], limit: int) -> Optional[Dict[str, Any]]:
+    """
+    Fetch up to limit hits for the filters through a temporary step.
+
+    Limits up to KM24_MAX_PAGE_SIZE are fetched in a single page; larger
+    limits are fetched as several full pages concurrently.
+    Hits are cached briefly, so a cached or in-flight fetch of at least
+    limit hits is reused without creating another step.
+
+    Returns:
+        Hits data, or None if none of the filters map to parts of the module
+    """
+    cache_key = _filters_cache_key(module_id, filters)
+    if cache_key is None:
+        return await _fetch_hits(module_id, filters, limit)
 
+    cached = _hits_cache.get(cache_key)
+    if cached and cached[0] >= limit:
+        task = cached[1]
+    else:
+        task = _track_background_task(asyncio.ensure_future(_fetch_hits(module_id, filters, limit)))
+        entry = (limit, task)
+        _hits_cache.set(cache_key, entry)
+        task.add_done_callback(lambda t: _evict_if_failed(_hits_cache, cache_key, entry, t))
+
+    # Shield so a disconnecting client doesn't cancel the fetch for others sharing it
+    return await asyncio.shield(task)
+
+
+async def _validate_filters(module_id: int, filters: Dict[str, Any]) -> ValidationResult:
+    """
+    Validate filters by creating a temporary step and checking hits.
+    """
     try:
-        # Get module details to build parts
-        module = await km24_client.get_module(module_id)
-
-        # Build part map
-        part_map = {p["slug"]: p["id"] for p in module.parts}
-
-        # Convert filters to parts
-        parts = []
-        for filter_name, filter_value in filters.items():
-            if filter_value and filter_name in part_map:
-                # Ensure value is a list
-                values = [filter_value] if not isinstance(filter_value, list) else filter_value
-                parts.append({
-                    "modulePartId": part_map[filter_name],
-                    "values": values
-                })
-
-        if not parts:
+        hits_data = await _create_and_fetch(module_id, filters, limit=HITS_PAGE_SIZE)
+
+        if hits_data is None:
             return ValidationResult(
                 is_valid=False,
                 sample_hits=[],
@@ -279,36 +513,11 @@ async def validate_filters_with_km24(module_id: int, filters: Dict[str, Any]) ->
                 suggestions=["Tilføj mindst ét filter for at indsnævre søgningen"]
             )
 
-        # Create temporary step
-        step_name = f"__temp_validation_{module_id}"
-        step = await km24_client.create_step(
-            name=step_name,
-            module_id=module_id,
-            parts=parts,
-            lookback_days=30
-        )
-
-        step_id = step["id"]
-
-        # Get hits
-        hits_data = await km24_client.get_step_hits(step_id, page_size=10)
-
         # Convert to our format
-        sample_hits = [
-            Hit(
-                title=hit.get("title", "Untitled"),
-                date=hit.get("hitDatetime"),
-                summary=hit.get("summary", hit.get("description", "")),
-                url=hit.get("url")
-            )
-            for hit in hits_data.get("items", [])[:3]
-        ]
+        sample_hits = [_to_hit(hit) for hit in hits_data.get("items", [])[:3]]
 
         hit_count = hits_data.get("count", 0)
 
-        # Delete temporary step
-        await km24_client.delete_step(step_id)
-
         # Generate warnings and suggestions
         warnings = []
         suggestions = []
@@ -328,11 +537,34 @@ async def validate_filters_with_km24(module_id: int, filters: Dict[str, Any]) ->
             suggestions=suggestions
         )
 
+    except httpx.HTTPError:
+        raise
     except Exception as e:
         logger.error(f"Error validating filters: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to validate filters: {str(e)}")
 
 
+async def validate_filters_with_km24(module_id: int, filters: Dict[str, Any]) -> ValidationResult:
+    """
+    Validate filters, reusing a cached or in-flight result for identical filters.
+    """
+    if not km24_client:
+        raise HTTPException(status_code=500, detail="KM24 API not configured")
+
+    cache_key = _filters_cache_key(module_id, filters)
+    if cache_key is None:
+        return await _validate_filters(module_id, filters)
+
+    task = _validation_cache.get(cache_key)
+    if task is None:
+        task = _track_background_task(asyncio.ensure_future(_validate_filters(module_id, filters)))
+        _validation_cache.set(cache_key, task)
+        task.add_done_callback(lambda t: _evict_if_failed(_validation_cache, cache_key, t, t))
+
+    # Shield so a disconnecting client doesn't cancel the validation for others sharing it
+    return await asyncio.shield(task)
+
+
 # --- API Endpoints ---
 @app.get("/health")
 async def health_check():
@@ -340,16 +572,13 @@ async def health_check():
     km24_status = "ok" if km24_client else "not configured"
     anthropic_status = "ok" if anthropic_client else "not configured"
 
-    # Try to ping KM24
+    # Read the cached module count; never block the probe on KM24 network I/O
+    km24_modules_count = 0
     if km24_client:
-        try:
-            modules = await km24_client.get_modules()
-            km24_modules_count = len(modules)
-        except:
-            km24_status = "error"
-            km24_modules_count = 0
-    else:
-        km24_modules_count = 0
+        if km24_client.modules_count is None:
+            km24_status = "error" if app.state.warmup_error is not None else "warming"
+        else:
+            km24_modules_count = km24_client.modules_count
 
     return {
         "status": "ok",
@@ -368,7 +597,7 @@ async def generate_recipe(request: GenerateRecipeRequest):
         logger.info(f"Generating recipe for goal: {request.goal}")
         recipe = await generate_recipe_with_ai(request.goal)
         return recipe
-    except HTTPException:
+    except (HTTPException, httpx.HTTPError):
         raise
     except Exception as e:
         logger.error(f"Error in generate_recipe: {e}")
@@ -384,13 +613,57 @@ async def validate_filters(request: ValidateFiltersRequest):
         logger.info(f"Validating filters for module {request.module_id}: {request.filters}")
         result = await validate_filters_with_km24(request.module_id, request.filters)
         return result
-    except HTTPException:
+    except (HTTPException, httpx.HTTPError):
         raise
     except Exception as e:
         logger.error(f"Error in validate_filters: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/monitoring/validate-recipe", response_model=List[ModuleValidation])
+async def validate_recipe(recipe: MonitoringRecipe):
+    """
+    Validate the filters of every module in a recipe concurrently.
+    """
+    if not km24_client:
+        raise HTTPException(status_code=500, detail="KM24 API not configured")
+
+    async def validate_module(module_id: int, filters: Dict[str, Any]) -> ValidationResult:
+        async with km24_client.validation_semaphore:
+            return await validate_filters_with_km24(module_id, filters)
+
+    try:
+        pairs = [
+            (strategy.name, module)
+            for strategy in recipe.strategies
+            for module in strategy.modules
+        ]
+        logger.info(f"Validating {len(pairs)} modules for recipe: {recipe.goal}")
+
+        # One bad module (e.g. an AI-invented module_id) shouldn't discard the other results
+        results = await asyncio.gather(
+            *(validate_module(module.module_id, module.filters) for _, module in pairs),
+            return_exceptions=True
+        )
+
+        validations = []
+        for (strategy_name, module), result in zip(pairs, results):
+            if isinstance(result, BaseException):
+                error = result.detail if isinstance(result, HTTPException) else str(result)
+                logger.warning(f"Failed to validate module {module.module_id} in {strategy_name}: {error}")
+                validations.append(
+                    ModuleValidation(strategy_name=strategy_name, module_id=module.module_id, error=error)
+                )
+            else:
+                validations.append(
+                    ModuleValidation(strategy_name=strategy_name, module_id=module.module_id, result=result)
+                )
+        return validations
+    except Exception as e:
+        logger.error(f"Error in validate_recipe: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/api/monitoring/search-hits", response_model=List[Hit])
 async def search_hits(request: SearchHitsRequest):
     """
@@ -399,13 +672,17 @@ async def search_hits(request: SearchHitsRequest):
     try:
         logger.info(f"Searching hits for module {request.module_id} with limit {request.limit}")
 
-        # Reuse validation logic to get hits
-        validation = await validate_filters_with_km24(request.module_id, request.filters)
+        if not km24_client:
+            raise HTTPException(status_code=500, detail="KM24 API not configured")
 
-        # Return more hits if requested
-        return validation.sample_hits[:request.limit]
+        hits_data = await _create_and_fetch(request.module_id, request.filters, limit=request.limit)
 
-    except HTTPException:
+        if hits_data is None:
+            return []
+
+        return [_to_hit(hit) for hit in hits_data.get("items", [])[:request.limit]]
+
+    except (HTTPException, httpx.HTTPError):
         raise
     except Exception as e:
         logger.error(f"Error in search_hits: {e}")
@@ -421,18 +698,11 @@ async def get_modules():
         raise HTTPException(status_code=500, detail="KM24 API not configured")
 
     try:
-        modules = await km24_client.get_modules()
-        return {
-            "modules": [
-                {
-                    "id": m.id,
-                    "title": m.title,
-                    "emoji": m.emoji,
-                    "description": m.description
-                }
-                for m in modules
-            ]
-        }
+        # Serve the pre-serialized body cached on the client
+        content = await km24_client.get_modules_json()
+        return Response(content=content, media_type="application/json")
+    except httpx.HTTPError:
+        raise
     except Exception as e:
         logger.error(f"Error getting modules: {e}")
         raise HTTPException(status_code=500, detail=str(e))